@@ -1,4 +1,7 @@
+import asyncio
+from collections import Counter, defaultdict
 import random
+import time
 
 import discord
 from discord.ext import commands, tasks
@@ -7,13 +10,16 @@ from utils import config, db
 
 
 GUILD_ID = config.secrets["discord"]["guild_id"]
+BALANCE_CACHE_TTL = 30
+EMBED_EDIT_DELAY = 0.5
 
 
 class Points(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.points_buffer = {}
+        self.points_buffer = defaultdict(int)
         self.predictions = {}
+        self.balances = BalanceCache()
         self.update_points.start()
 
     points = discord.SlashCommandGroup("points", "points :)")
@@ -25,7 +31,7 @@ class Points(commands.Cog):
         if user == self.bot.user or user.bot:
             return
 
-        self.points_buffer[user.id] = random.randint(7, 25)
+        self.points_buffer[user.id] += random.randrange(7, 26)
 
     @points.command(
         name="balance",
@@ -37,11 +43,7 @@ class Points(commands.Cog):
 
         target_user = user if user else ctx.user
 
-        sql = "SELECT points FROM users WHERE discordid = %s;"
-        data = [target_user.id]
-        result = await db.fetch_one(sql, data)
-
-        points = result[0] if result else 0
+        points = await self.balances.get(target_user.id)
         embed = discord.Embed(
             title=f"{target_user.display_name}'s points",
             description=f"{points} points",
@@ -63,7 +65,7 @@ class Points(commands.Cog):
         message = await ctx.send(f"PREDICTION: **{title}**")
         thread = await message.create_thread(name=f"PREDICTION: {title}")
 
-        prediction = Prediction(title, option_a, option_b, thread)
+        prediction = Prediction(title, option_a, option_b, thread, self.balances)
         await prediction.create_prediction()
 
         self.predictions[ctx.user.id] = prediction
@@ -123,37 +125,106 @@ class Points(commands.Cog):
 
     @tasks.loop(seconds=60)
     async def update_points(self):
+        self.balances.prune()
         if not self.points_buffer:
             return
 
+        # Swap the buffer out before awaiting so messages that arrive during
+        # the flush land in the fresh buffer instead of being cleared
+        buffer, self.points_buffer = self.points_buffer, defaultdict(int)
+
         sql = """INSERT INTO users (discordid, points)
-            VALUES (%s, %s)
+            SELECT unnest(%s::bigint[]), unnest(%s::bigint[])
             ON CONFLICT (discordid)
             DO UPDATE SET points = users.points + EXCLUDED.points;
         """
-        data = [(user_id, points) for user_id, points in self.points_buffer.items()]
-        await db.perform_many(sql, data)
-
-        self.points_buffer.clear()
+        data = [list(buffer.keys()), list(buffer.values())]
+        try:
+            await db.perform_one(sql, data)
+        except Exception as e:
+            # Put the points back so the next run retries them; raising here
+            # would stop the loop
+            for user_id, points in buffer.items():
+                self.points_buffer[user_id] += points
+            print(f"Failed to flush points buffer: {e}")
+            return
+        self.balances.invalidate(buffer.keys())
 
 
 def setup(bot):
     bot.add_cog(Points(bot))
 
 
+class BalanceCache:
+    """Short-lived cache of users.points.
+
+    Every write to users.points should call invalidate so a cached balance is
+    dropped as soon as it changes.
+    """
+
+    def __init__(self):
+        # discordid -> (points, time fetched)
+        self.cache = {}
+        # Bumped by every invalidation, so a SELECT that raced a write isn't
+        # cached
+        self.generation = 0
+
+    async def get(self, user_id):
+        cached = self.cache.get(user_id)
+        if cached:
+            if time.monotonic() - cached[1] < BALANCE_CACHE_TTL:
+                return cached[0]
+            del self.cache[user_id]
+
+        generation = self.generation
+        sql = "SELECT points FROM users WHERE discordid = %s;"
+        data = [user_id]
+        result = await db.fetch_one(sql, data)
+
+        points = result[0] if result else 0
+        if generation == self.generation:
+            self.cache[user_id] = (points, time.monotonic())
+        return points
+
+    def invalidate(self, user_ids):
+        self.generation += 1
+        for user_id in user_ids:
+            self.cache.pop(user_id, None)
+
+    def prune(self):
+        now = time.monotonic()
+        for user_id, (_, fetched) in list(self.cache.items()):
+            if now - fetched >= BALANCE_CACHE_TTL:
+                del self.cache[user_id]
+
+
+async def credit_points(balances, points_by_user, payout=1.0):
+    if not points_by_user:
+        return
+
+    sql = """UPDATE users SET points = users.points + round(v.p * %s)::bigint
+        FROM (SELECT unnest(%s::bigint[]) AS id, unnest(%s::bigint[]) AS p) v
+        WHERE users.discordid = v.id;
+    """
+    data = [payout, list(points_by_user.keys()), list(points_by_user.values())]
+    await db.perform_one(sql, data)
+    balances.invalidate(points_by_user.keys())
+
+
 class Prediction:
-    def __init__(self, title, option_a, option_b, thread):
+    def __init__(self, title, option_a, option_b, thread, balances):
         self.title = title
         self.option_a = option_a
         self.option_b = option_b
         self.thread = thread
+        self.balances = balances
 
     async def create_prediction(self):
         embed = discord.Embed(
             title=self.title,
             color=discord.Color.from_rgb(78, 42, 132),
         )
-        self.view = PredictionView(self.option_a, self.option_b, embed)
+        self.view = PredictionView(self.option_a, self.option_b, embed, self.balances)
         self.message = await self.thread.send(
             "", embed=self.view.update_embed(), view=self.view
         )
@@ -165,62 +236,38 @@ class Prediction:
         await self.message.reply("Prediction locked.")
 
     async def complete_prediction(self, winner):
+        # Lock before crediting so a bet whose debit is still in flight is
+        # refunded by modal_callback instead of missing the payout
+        self.view.locked = True
         if not self.view.option_a_points or not self.view.option_b_points:
-            sql = "UPDATE users SET points = points + %s WHERE discordid = %s;"
-            data = [
-                (points, user_id)
-                for user_id, points in self.view.option_a_points.items()
-            ] + [
-                (points, user_id)
-                for user_id, points in self.view.option_b_points.items()
-            ]
-            await db.perform_many(sql, data)
+            await credit_points(self.balances, self.view.all_bets())
             await self.view.lock_view()
             await self.message.reply("Everyone voted the same way! Points refunded.")
             return
 
-        sql = "UPDATE users SET points = points + %s WHERE discordid = %s;"
         if winner == self.option_a:
             payout = self.view.odds_a
-            data = [
-                (round(points * payout), user_id)
-                for user_id, points in self.view.option_a_points.items()
-            ]
+            await credit_points(self.balances, self.view.option_a_points, payout)
         else:
             payout = self.view.odds_b
-            data = [
-                (round(points * payout), user_id)
-                for user_id, points in self.view.option_b_points.items()
-            ]
-        await db.perform_many(sql, data)
+            await credit_points(self.balances, self.view.option_b_points, payout)
         format = "Prediction completed -- {} points distributed to {} ({}x payout)."
         if winner == self.option_a:
-            message = format.format(
-                sum(self.view.option_b_points.values()),
-                self.option_a,
-                round(payout, 2),
-            )
+            message = format.format(self.view.total_b, self.option_a, round(payout, 2))
         else:
-            message = format.format(
-                sum(self.view.option_a_points.values()),
-                self.option_b,
-                round(payout, 2),
-            )
+            message = format.format(self.view.total_a, self.option_b, round(payout, 2))
         await self.view.lock_view()
         await self.message.reply(message)
 
     async def refund_prediction(self):
-        sql = "UPDATE users SET points = points + %s WHERE discordid = %s;"
-        data = [
-            (points, user_id) for user_id, points in self.view.option_a_points.items()
-        ] + [(points, user_id) for user_id, points in self.view.option_b_points.items()]
-        await db.perform_many(sql, data)
+        self.view.locked = True
+        await credit_points(self.balances, self.view.all_bets())
         await self.view.lock_view()
         await self.message.reply("Prediction cancelled. Points refunded.")
 
 
 class PredictionView(discord.ui.View):
-    def __init__(self, option_a, option_b, embed):
+    def __init__(self, option_a, option_b, embed, balances):
         super().__init__(timeout=1200)
 
         self.option_a = option_a
@@ -228,32 +275,32 @@ class PredictionView(discord.ui.View):
         self.option_b = option_b
         self.option_b_points = {}
 
+        # Running totals so the embed doesn't re-sum every bet on each update
+        self.total_a = 0
+        self.count_a = 0
+        self.total_b = 0
+        self.count_b = 0
+        self.update_odds()
+
         self.message = None
+        self.balances = balances
         self.embed = embed
+        self.embed.add_field(name=self.option_a, value="")
+        self.embed.add_field(name=self.option_b, value="")
         self.locked = False
+        self.edit_task = None
 
         def create_button(label):
             async def button_callback(interaction):
-                if any(
-                    [
-                        label == self.option_a
-                        and interaction.user.id in self.option_b_points,
-                        label == self.option_b
-                        and interaction.user.id in self.option_a_points,
-                    ]
-                ):
+                if self.has_opposing_bet(interaction.user.id, label):
                     await interaction.response.send_message(
                         f"{interaction.user.mention} tried to change sides..."
                     )
                     return
-                sql = "SELECT points FROM users WHERE discordid = %s;"
-                data = [interaction.user.id]
-                result = await db.fetch_one(sql, data)
+                user_points = await self.balances.get(interaction.user.id)
 
                 await interaction.response.send_modal(
-                    PredictionModal(
-                        self.modal_callback, label, result[0] if result else 0
-                    )
+                    PredictionModal(self.modal_callback, label, user_points)
                 )
 
             button = discord.ui.Button(label=label)
@@ -263,40 +310,51 @@ class PredictionView(discord.ui.View):
         self.add_item(create_button(self.option_a))
         self.add_item(create_button(self.option_b))
 
+    def has_opposing_bet(self, user_id, option):
+        if option == self.option_a:
+            return user_id in self.option_b_points
+        return user_id in self.option_a_points
+
+    def all_bets(self):
+        # Sum per user rather than merging, so no stake is dropped if a user
+        # somehow ended up on both sides
+        return Counter(self.option_a_points) + Counter(self.option_b_points)
+
+    def update_odds(self):
+        self.odds_a = 1 + (self.total_b / self.total_a) if self.total_a else 1
+        self.odds_b = 1 + (self.total_a / self.total_b) if self.total_b else 1
+
     def update_embed(self):
-        # TODO: add odds
-        self.embed.clear_fields()
+        # Fields are created once in __init__; only their values change
         format = "{} points\n{} users\n{}x payout"
-        self.odds_a = (
-            1
-            + (sum(self.option_b_points.values()) / sum(self.option_a_points.values()))
-            if self.option_a_points
-            else 1
-        )
-        self.odds_b = (
-            1
-            + (sum(self.option_a_points.values()) / sum(self.option_b_points.values()))
-            if self.option_b_points
-            else 1
-        )
-        self.embed.add_field(
+        self.embed.set_field_at(
+            0,
             name=self.option_a,
-            value=format.format(
-                sum(self.option_a_points.values()),
-                len(self.option_a_points),
-                round(self.odds_a, 2),
-            ),
+            value=format.format(self.total_a, self.count_a, round(self.odds_a, 2)),
         )
-        self.embed.add_field(
+        self.embed.set_field_at(
+            1,
             name=self.option_b,
-            value=format.format(
-                sum(self.option_b_points.values()),
-                len(self.option_b_points),
-                round(self.odds_b, 2),
-            ),
+            value=format.format(self.total_b, self.count_b, round(self.odds_b, 2)),
         )
         return self.embed
 
+    def schedule_embed_edit(self):
+        # Coalesce bets placed within EMBED_EDIT_DELAY into a single edit
+        if self.edit_task is None:
+            self.edit_task = asyncio.create_task(self.flush_embed_edit())
+
+    async def flush_embed_edit(self):
+        await asyncio.sleep(EMBED_EDIT_DELAY)
+        self.edit_task = None
+        # lock_view already sent the final embed
+        if self.is_finished():
+            return
+        try:
+            await self.message.edit(embed=self.update_embed())
+        except discord.HTTPException as e:
+            print(f"Failed to update prediction embed: {e}")
+
     async def on_timeout(self):
         if self.locked:
             return
@@ -306,17 +364,54 @@ class PredictionView(discord.ui.View):
     async def lock_view(self):
         self.locked = True
         self.disable_all_items()
-        await self.message.edit(view=self)
+        await self.message.edit(embed=self.update_embed(), view=self)
+        # Nothing can be clicked anymore, so drop the view from the bot's view
+        # store now instead of holding it until the timeout
+        self.stop()
 
     async def modal_callback(self, user, points, option):
+        # The button only checks sides on click, so two modals opened before
+        # either was submitted could otherwise bet on both options
+        if self.locked:
+            return "Prediction is locked."
+        if self.has_opposing_bet(user.id, option):
+            return "You can't bet on both sides!"
+
+        # Check and debit the balance in one statement so two bets can't both
+        # spend the same points
+        sql = """UPDATE users SET points = points - %s
+            WHERE discordid = %s AND points >= %s
+            RETURNING points;
+        """
+        data = [points, user.id, points]
+        result = await db.fetch_one(sql, data)
+        self.balances.invalidate([user.id])
+        if not result:
+            return "You don't have enough points!"
+
+        # The prediction may have been locked or the user may have bet on the
+        # other side during the debit; nothing else can run between these
+        # checks and recording the bet
+        if self.locked:
+            await credit_points(self.balances, {user.id: points})
+            return "Prediction is locked."
+        if self.has_opposing_bet(user.id, option):
+            await credit_points(self.balances, {user.id: points})
+            return "You can't bet on both sides!"
+
         if option == self.option_a:
-            prev = self.option_a_points.pop(user.id, 0)
+            prev = self.option_a_points.get(user.id, 0)
             self.option_a_points[user.id] = prev + points
+            self.total_a += points
+            if prev == 0:
+                self.count_a += 1
         else:
-            prev = self.option_b_points.pop(user.id, 0)
+            prev = self.option_b_points.get(user.id, 0)
             self.option_b_points[user.id] = prev + points
-
-        await self.message.edit(embed=self.update_embed())
+            self.total_b += points
+            if prev == 0:
+                self.count_b += 1
+        self.update_odds()
 
         format = "{} bet {} points on **{}**"
         format_prev = "\n(up from {})"
@@ -324,10 +419,7 @@ class PredictionView(discord.ui.View):
         if prev > 0:
             message += format_prev.format(prev)
 
-        sql = "UPDATE users SET points = points - %s WHERE discordid = %s;"
-        data = [points, user.id]
-        await db.perform_one(sql, data)
-
+        self.schedule_embed_edit()
         await self.message.reply(message)
 
 
@@ -369,4 +461,6 @@ class PredictionModal(discord.ui.Modal):
             return
 
         await interaction.response.defer()
-        await self.view_callback(interaction.user, points, self.option)
+        error = await self.view_callback(interaction.user, points, self.option)
+        if error:
+            await interaction.followup.send(error, ephemeral=True)